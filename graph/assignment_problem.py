@@ -1,3 +1,4 @@
+from math import exp, expm1, inf, log
 from uuid import uuid4
 
 from graph import Graph
@@ -149,78 +150,111 @@ def wtap_solver(probabilities, weapons, target_values):
     targetset.clear()
     target_prob_set.clear()
 
-    # then: Calculate the solution.
-    assignments = Graph()
-    current_target_values = sum(target_values.values()) + 1
-
-    improvements = {}
-    while True:
-        for w in weapons:
-            # calculate the effect of engaging in all targets.
-            effect_of_assignment = {}
-            for _, t, p in probabilities.edges(from_node=w):
-                current_engagement = _get_current_engagement(w, assignments)
-                if current_engagement != t:
-                    if w in assignments and current_engagement is not None:
-                        assignments.del_edge(w, current_engagement)
-                    assignments.add_edge(w, t, value=probabilities.edge(w, t))
-                effect_of_assignment[t] = _damages(probabilities=probabilities,
-                                                   assignment=assignments,
-                                                   target_values=target_values)
-
-            damage_and_targets = [(v, t) for t, v in effect_of_assignment.items()]
-            damage_and_targets.sort()
-            best_alt_damage, best_alt_target = damage_and_targets[0]
-            nett_effect = current_target_values - best_alt_damage
-            improvements[w] = max(0, nett_effect)
-
-            current_engagement = _get_current_engagement(w, assignments)
-            if current_engagement != best_alt_target:
-                if w in assignments and current_engagement is not None:
-                    assignments.del_edge(w, current_engagement)
-                assignments.add_edge(w, best_alt_target, probabilities.edge(w, best_alt_target))
-            current_target_values = effect_of_assignment[best_alt_target]
-        if sum(improvements.values()) == 0:
-            break
-    return current_target_values, assignments
+    # then: materialise the problem as dense tables indexed by position,
+    # so that the search below works on lists instead of the graph.
+    targets = list(target_values)
+    target_idx = {t: i for i, t in enumerate(targets)}
+    V = [target_values[t] for t in targets]
+    P = [[probabilities.edge(w, t, 0) for t in targets] for w in weapons]
+    candidates = [sorted(target_idx[t] for t in probabilities.nodes(from_node=w) if t in target_idx)
+                  for w in weapons]
 
+    # finally: Calculate the solution.
+    current_target_values, assign = _wtap_greedy(P, V, candidates, targets)
 
-def _get_current_engagement(d, assignment):
-    """ helper for WTAP solver
-    Calculates the current engagement
-    :param d: device
-    :param assignment: class Graph.
-    :return:
-    """
-    if d in assignment:
-        for d, t, v in assignment.edges(from_node=d):
-            return t
-    return None
+    assignments = Graph()
+    for w, t_i in zip(weapons, assign):
+        if t_i is not None:
+            t = targets[t_i]
+            assignments.add_edge(w, t, probabilities.edge(w, t))
+    return current_target_values, assignments
 
 
-def _damages(probabilities, assignment, target_values):
+def _wtap_greedy(P, V, candidates, targets, max_passes=1000):
     """ helper for WTAP solver
-    :param probabilities: graph with probability of device effect on target
-    :param assignment: graph with links between device and targets.
-    :param target_values: dict with [target]=value.
-    :return: total survival value.
+    Greedy assignment followed by search for improvements, until
+    a full pass over the weapons yields no improvement, or until
+    max_passes passes have been made.
+    :param P: list of rows, where P[weapon][target] = probability.
+    :param V: list with V[target] = value.
+    :param candidates: list with the target indices each weapon may engage.
+    :param targets: list of target ids, used to break ties on the lowest id.
+    :param max_passes: int, guard against passes that never settle.
+    :return: tuple: value of targets after attack, list with the target index
+    of each weapon (None if unassigned).
     """
-    assert isinstance(probabilities, Graph)
-    assert isinstance(assignment, Graph)
-    assert isinstance(target_values, dict)
+    Q = [[1 - p for p in row] for row in P]  # probability of each target surviving each weapon.
+    # survival is tracked in the log domain, so that it is a sum rather than
+    # a chain of products. A certain kill (q = 0) is log(0) = -inf.
+    logQ = [[log(q) if q > 0 else -inf for q in row] for row in Q]
+    expm1_logQ = [[expm1(lq) for lq in row] for row in logQ]  # constant per engagement, so computed once.
+    Vf = [float(v) for v in V]  # the search runs on floats, whatever the type of V.
+    log_S = [0.0] * len(V)  # log of the survival probability of each target.
+    assign = [None] * len(P)  # index of the target engaged by each weapon.
+
+    # effects are <= 0, and those within the rounding of the log domain
+    # count as ties: a is better than b only if a < b * tie.
+    tie = 1 + 1e-9
+
+    improvements = [0] * len(P)
+    for _ in range(max_passes):
+        moved = False
+        for d_i, targets_i in enumerate(candidates):
+            if not targets_i:
+                continue
+            lq_row, em_row = logQ[d_i], expm1_logQ[d_i]
+            current_engagement_i = assign[d_i]
+            if current_engagement_i is not None:
+                # the weapon is taken off its current target by subtracting
+                # its log(q). After a certain kill that is -inf - -inf, which
+                # is undefined, so then the survival is rebuilt instead.
+                lq = lq_row[current_engagement_i]
+                if lq > -inf:
+                    log_S[current_engagement_i] -= lq
+                else:
+                    log_S[current_engagement_i] = sum(logQ[w_i][t_i] for w_i, t_i in enumerate(assign)
+                                                      if t_i == current_engagement_i and w_i != d_i)
 
-    survival_value = {target: [] for target in target_values}
-    for edge in assignment.edges():
-        weapon, target, damage = edge
+            # calculate the effect of engaging in all targets.
+            best_target_i, best_alt_damage, current_damage = None, None, 0
+            for t_i in targets_i:
+                effect = Vf[t_i] * exp(log_S[t_i]) * em_row[t_i]
+                if best_target_i is None or effect < best_alt_damage * tie:
+                    best_target_i, best_alt_damage = t_i, effect
+                elif not best_alt_damage < effect * tie and _lower_id(targets[t_i], targets[best_target_i]):
+                    best_target_i, best_alt_damage = t_i, effect
+                if t_i == current_engagement_i:
+                    current_damage = effect
+            if best_alt_damage < current_damage * tie:
+                improvements[d_i] = current_damage - best_alt_damage
+            else:
+                improvements[d_i] = 0
+
+            if best_target_i != current_engagement_i:
+                moved = True
+            assign[d_i] = best_target_i
+            log_S[best_target_i] += lq_row[best_target_i]
+        # a move to a tied target improves nothing by itself, but changes the
+        # survival the other weapons see, so it takes another pass to settle.
+        if sum(improvements) == 0 and not moved:
+            break
 
-        p = probabilities.edge(weapon, target)
-        survival_value[target].append(p)
+    # the value is computed from Q and V directly, to keep it exact for
+    # Fractions and Decimals.
+    S = [1] * len(V)
+    for d_i, t_i in enumerate(assign):
+        if t_i is not None:
+            S[t_i] *= Q[d_i][t_i]
+    return sum(s * v for s, v in zip(S, V)), assign
 
-    total_survival_value = 0
-    for target, assigned_probabilities in survival_value.items():
-        p = 1
-        for p_ in assigned_probabilities:
-            p *= (1 - p_)
-        total_survival_value += p * target_values[target]
 
-    return total_survival_value
\ No newline at end of file
+def _lower_id(a, b):
+    """ helper for WTAP solver
+    Breaks ties between targets on the lowest id. Ids that can't be
+    compared, such as int and str, keep the first target seen.
+    :return: bool: True if a < b.
+    """
+    try:
+        return a < b
+    except TypeError:
+        return False
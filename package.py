@@ -2,6 +2,7 @@ from pathlib import Path
 from datetime import datetime
 import subprocess
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 # -------------------------------------------
 # This script packages Graph-theory for pypi
@@ -23,12 +24,27 @@ packages = [
     folder / 'README.md',
 ]
 
-sha = hashlib.sha3_256()
-for package_path in packages:
+CHUNK_SIZE = 1 << 16  # 64 KiB: files are streamed to the hasher in chunks rather than read whole.
+
+
+def file_digest(package_path):
+    """ the sha256 of a file, as (relative path, digest) """
     assert package_path.exists(), str(package_path)
+    sha = hashlib.sha256()  # a build identity, so the hardware accelerated sha256 will do.
     with open(str(package_path), mode='rb') as fi:
-        data = fi.read()
-        sha.update(data)
+        for chunk in iter(lambda: fi.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return package_path.relative_to(folder).as_posix(), sha.digest()
+
+
+# the files are hashed in parallel, and their digests combined in path order.
+with ThreadPoolExecutor() as executor:
+    digests = sorted(executor.map(file_digest, packages))
+
+sha = hashlib.sha256()
+for name, digest in digests:
+    sha.update(name.encode('utf-8'))
+    sha.update(digest)
 
 current_build_tag = sha.hexdigest()
 
@@ -36,19 +52,20 @@ current_build_tag = sha.hexdigest()
 setup = folder / "setup.py"
 build_tag_idx, version_idx = None, None
 with open(str(setup), encoding='utf-8') as f:
-    lines = f.readlines()
-    for idx, row in enumerate(lines):
-        if "build_tag" in row:
-            if build_tag_idx is None:
-                build_tag_idx = idx
-            a = row.find('"') + 1
-            b = row.rfind('"')
-            last_build_tag = row[a:b]
-        if "version=" in row and version_idx is None:
-            version_idx = idx
+    lines = f.readlines()  # read once: the same lines are updated in step 4.
+
+for idx, row in enumerate(lines):
+    if "build_tag" in row:
+        if build_tag_idx is None:
+            build_tag_idx = idx
+        a = row.find('"') + 1
+        b = row.rfind('"')
+        last_build_tag = row[a:b]
+    if "version=" in row and version_idx is None:
+        version_idx = idx
 
 if build_tag_idx is None:
-    build_tag_idx = 0
+    raise ValueError("build_tag not declared in setup.py")
 if version_idx is None:
     raise ValueError("version not declared in setup.py")
 
@@ -61,14 +78,11 @@ else:  # Step 4. make a new setup.py.
     version = '\"{}.{}.{}.{}\"'.format(v.year, v.month, v.day, v.hour * 3600 + v.minute * 60 + v.second)
 
     # update the setup.py file.
-    with open(str(setup), encoding='utf-8') as fi:
-        old_setup = fi.readlines()
-        old_setup[build_tag_idx] = 'build_tag = "{}"\n'.format(current_build_tag)
-        old_setup[version_idx] = '    version={},\n'.format(version)
+    lines[build_tag_idx] = 'build_tag = "{}"\n'.format(current_build_tag)
+    lines[version_idx] = '    version={},\n'.format(version)
 
-    script = "".join(old_setup)
     with open(str(setup), mode='w', encoding='utf-8') as f:
-        f.write(script)
+        f.writelines(lines)
 
     response = subprocess.Popen(["python", "setup.py", "sdist"], stdout=subprocess.PIPE)
     response.wait()
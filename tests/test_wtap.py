@@ -1,5 +1,7 @@
+from collections import Counter, defaultdict
+from decimal import Decimal
 from fractions import Fraction as F
-from itertools import permutations, combinations_with_replacement
+from functools import lru_cache
 
 from graph import Graph
 from graph.assignment_problem import wtap_solver
@@ -73,6 +75,82 @@ def test_wtap_with_fractional_probabilities():
     assert float(value) == 16.07
 
 
+def test_wtap_with_decimal_probabilities():
+    weapons = [1, 2, 3]
+    probabilities = [(w, t, Decimal('0.1')) for w in weapons for t in (5, 6, 7)]
+    target_values = {5: Decimal(5), 6: Decimal(6), 7: Decimal(7)}
+    g = Graph(from_list=probabilities)
+
+    value, assignments = wtap_solver(probabilities=g,
+                                     weapons=weapons,
+                                     target_values=target_values)
+    assert isinstance(assignments, Graph)
+    assert set(assignments.edges()) == {(2, 7, Decimal('0.1')), (3, 6, Decimal('0.1')), (1, 7, Decimal('0.1'))}
+    assert value == Decimal('16.07')
+
+
+def test_wtap_with_certain_kill():
+    weapons = [1, 2]
+    probabilities = [
+        (1, 3, 1.0),
+        (1, 4, 0.5),
+        (2, 3, 1.0),
+        (2, 4, 0.5),
+    ]
+    target_values = {3: 10, 4: 5}
+    g = Graph(from_list=probabilities)
+
+    value, assignments = wtap_solver(probabilities=g,
+                                     weapons=weapons,
+                                     target_values=target_values)
+    assert set(assignments.edges()) == {(1, 3, 1.0), (2, 4, 0.5)}
+    assert value == 2.5
+
+
+def test_wtap_ties_go_to_lowest_target():
+    g = Graph(from_list=[('w', 1, 0.5), ('w', 2, 0.5)])
+    value, assignments = wtap_solver(probabilities=g,
+                                     weapons=['w'],
+                                     target_values={2: 10, 1: 10})
+    assert set(assignments.edges()) == {('w', 1, 0.5)}
+    assert value == 15
+
+
+def test_wtap_with_mixed_target_ids():
+    probabilities = [
+        ('w1', 'a', 0.5),
+        ('w1', 2, 0.3),
+        ('w2', 'a', 0.4),
+        ('w2', 2, 0.6),
+    ]
+    g = Graph(from_list=probabilities)
+    value, assignments = wtap_solver(probabilities=g,
+                                     weapons=['w1', 'w2'],
+                                     target_values={'a': 5, 2: 3})
+    assert set(assignments.edges()) == {('w1', 'a', 0.5), ('w2', 2, 0.6)}
+    assert round(value, 2) == 3.7
+
+
+def test_wtap_passes_again_after_a_tied_move():
+    # w4 moving to target 102 is a tie, but it makes 102 the better
+    # target for w0, which was already passed over in that pass.
+    probabilities = {
+        'w0': {100: 0.5, 101: 0.1, 102: 0.9, 103: 0.2},
+        'w1': {100: 0.9, 101: 0.2, 102: 0.3, 103: 0.9},
+        'w2': {100: 0.9, 101: 0.2, 102: 0.9, 103: 0.2},
+        'w3': {100: 0.1, 101: 0.5, 102: 0.5, 103: 1.0},
+        'w4': {100: 0.1, 101: 0.9, 102: 0.9, 103: 0.5},
+        'w5': {100: 0.2, 101: 1.0, 102: 1.0, 103: 0.9},
+    }
+    g = Graph(from_dict=probabilities)
+    value, assignments = wtap_solver(probabilities=g,
+                                     weapons=list(probabilities),
+                                     target_values={101: 5, 103: 5, 102: 5, 100: 10})
+    assert set(assignments.edges()) == {('w0', 102, 0.9), ('w1', 100, 0.9), ('w2', 100, 0.9),
+                                        ('w3', 103, 1.0), ('w4', 102, 0.9), ('w5', 101, 1.0)}
+    assert round(value, 2) == 0.15
+
+
 def test_exhaust_all_initialisation_permutations():
     """ Uses the wikipedia WTAP setup. """
     g, weapons, target_values = wikipedia_wtap_setup()
@@ -81,9 +159,15 @@ def test_exhaust_all_initialisation_permutations():
     quality_score = 0
     quality_required = 0.97
 
+    # weapons of the same type are interchangeable, so only the distinct
+    # orderings of weapon types are tested, with one labelling each.
+    weapons_by_type = {}
+    for weapon in weapons:
+        weapons_by_type.setdefault(_weapon_type(weapon), []).append(weapon)
+
     variations = {}
     damages = {}
-    perms = set(permutations(weapons, len(weapons)))
+    perms = set(_multiset_permutations([_weapon_type(w) for w in weapons]))
     c = 0
     while perms:
 
@@ -91,10 +175,10 @@ def test_exhaust_all_initialisation_permutations():
         perm2 = tuple(reversed(perm))
         perms.remove(perm2)
         damage1, ass1 = wtap_solver(probabilities=g,
-                                    weapons=list(perm),
+                                    weapons=_label(perm, weapons_by_type),
                                     target_values=target_values)
         damage2, ass2 = wtap_solver(probabilities=g,
-                                    weapons=list(perm2),
+                                    weapons=_label(perm2, weapons_by_type),
                                     target_values=target_values)
 
         damage_n = min(damage1, damage2)
@@ -103,9 +187,11 @@ def test_exhaust_all_initialisation_permutations():
         else:
             assignment = ass2
 
+        counts = _count_by_wtype(assignment)
         damage = wtap_damage_assessment(probabilities=g,
                                         assignment=assignment,
-                                        target_values=target_values)
+                                        target_values=target_values,
+                                        counts=counts)
         assert round(damage_n, 2) == round(damage, 2)
         damage = round(damage, 2)
 
@@ -113,7 +199,7 @@ def test_exhaust_all_initialisation_permutations():
         c += 1
 
         if damage not in damages:
-            s = "{:.3f} : {}".format(damage, wikipedia_wtap_pretty_printer(assignment))
+            s = "{:.3f} : {}".format(damage, wikipedia_wtap_pretty_printer(assignment, counts=counts))
             damages[damage] = s
         if damage not in variations:
             variations[damage] = 1
@@ -132,27 +218,88 @@ def test_exhaust_all_initialisation_permutations():
 
 
 def test_exhaustive_search_to_verify_wtap():
-    """ Uses the wikipedia WTAP setup. """
+    """ Uses the wikipedia WTAP setup.
+
+    Branch and bound over the targets of each weapon: a branch is cut when
+    even the best possible kill ratio of the remaining weapons can't beat
+    the best result. As weapons of the same type are interchangeable, a
+    weapon never engages an earlier target than the previous weapon of
+    its type.
+    """
     g, weapons, target_values = wikipedia_wtap_setup()
+    targets = list(target_values)
+
+    # bound[i] = lowest fraction of the value that weapons[i:] can leave.
+    bound = [1] * (len(weapons) + 1)
+    for i in reversed(range(len(weapons))):
+        q_min = min(1 - g.edge(weapons[i], t) for t in targets)
+        bound[i] = bound[i + 1] * q_min
 
     best_result = sum(target_values.values()) + 1
     best_assignment = None
     c = 0
-    for perm in permutations(weapons, len(weapons)):
-        for combination in combinations_with_replacement([1, 2, 3], len(weapons)):
-            edges = [(w, t, g.edge(w, t)) for w, t in zip(perm, combination)]
-            a = Graph(from_list=edges)
-            r = wtap_damage_assessment(probabilities=g,
-                                       assignment=a,
-                                       target_values=target_values)
-            if r < best_result:
-                best_result = r
+
+    def search(weapon_i, survival, edges):
+        nonlocal best_result, best_assignment, c
+        c += 1
+        value = sum(survival[t] * target_values[t] for t in targets)
+        if weapon_i == len(weapons):
+            if value < best_result:
+                best_result = value
                 best_assignment = edges
-            c += 1
-    print("{} is best result out of {:,} options(exhaustive search):\n{}".format(best_result, c, best_assignment))
+            return
+        if value * bound[weapon_i] > best_result:
+            return
+
+        weapon = weapons[weapon_i]
+        first_target_i = 0
+        if weapon_i > 0 and _weapon_type(weapons[weapon_i - 1]) == _weapon_type(weapon):
+            first_target_i = targets.index(edges[-1][1])
+        for t in targets[first_target_i:]:
+            p = g.edge(weapon, t)
+            s = dict(survival)
+            s[t] *= 1 - p
+            search(weapon_i + 1, s, edges + [(weapon, t, p)])
+
+    search(0, dict.fromkeys(targets, 1), [])
+
+    best_result = wtap_damage_assessment(probabilities=g,
+                                         assignment=Graph(from_list=best_assignment),
+                                         target_values=target_values)
+    print("{} is best result out of {:,} nodes (branch and bound):\n{}".format(best_result, c, best_assignment))
     assert best_result == 4.95, best_result
 
 
+def _multiset_permutations(items):
+    """ generates each distinct ordering of items once, in lexicographic order.
+    :param items: list of sortable items, possibly with repetitions.
+    :return: generator of tuples
+    """
+    a = sorted(items)
+    while True:
+        yield tuple(a)
+        i = len(a) - 2
+        while i >= 0 and a[i] >= a[i + 1]:
+            i -= 1
+        if i < 0:
+            return
+        j = len(a) - 1
+        while a[j] <= a[i]:
+            j -= 1
+        a[i], a[j] = a[j], a[i]
+        a[i + 1:] = reversed(a[i + 1:])
+
+
+def _label(wtypes, weapons_by_type):
+    """ turns a sequence of weapon types into a list of weapons.
+    :param wtypes: sequence of weapon types, such as ("tank", "ship", ...)
+    :param weapons_by_type: dict with weapon type: list of weapons.
+    :return: list of weapons.
+    """
+    available = {wtype: iter(weapons) for wtype, weapons in weapons_by_type.items()}
+    return [next(available[wtype]) for wtype in wtypes]
+
+
 def wikipedia_wtap_setup():
     """
     A commander has 5 tanks, 2 aircraft and 1 sea vessel and is told to
@@ -198,76 +345,69 @@ def wikipedia_wtap_setup():
     return g, weapons, target_values
 
 
-def wtap_damage_assessment(probabilities, assignment, target_values):
+def wtap_damage_assessment(probabilities, assignment, target_values, counts=None):
     """
     :param probabilities: graph.
     :param assignment: graph
     :param target_values: dictionary
+    :param counts: (optional) _count_by_wtype(assignment), if already known.
     :return: total survival value of the targets.
     """
     assert isinstance(probabilities, Graph)
     assert isinstance(assignment, Graph)
-    result = assignment.edges()
     assert isinstance(target_values, dict)
+    if counts is None:
+        counts = _count_by_wtype(assignment)
+
+    survival = dict.fromkeys(target_values, 1)
+    for target, wtypes in counts.items():
+        for wtype, quantity in wtypes.items():
+            p_base = (1 - probabilities.edge(wtype + "-0", target))
+            # quantities are small ints, so multiplying beats the generic float pow.
+            if quantity == 1:
+                survival[target] *= p_base
+            elif quantity == 2:
+                survival[target] *= p_base * p_base
+            elif quantity == 3:
+                survival[target] *= p_base * p_base * p_base
+            else:
+                survival[target] *= p_base ** quantity
 
-    survival_value = {}
-    for item in result:
-        weapon, target, damage = item
-        if target not in survival_value:
-            survival_value[target] = {}
-        wtype = weapon.split("-")[0]
-        if wtype not in survival_value[target]:
-            survival_value[target][wtype] = 0
-        survival_value[target][wtype] += 1
+    return sum(p * target_values[target] for target, p in survival.items())
 
-    total_survival_value = 0
-    for target, assigned_weapons in survival_value.items():
-        p = 1
-        for wtype, quantity in assigned_weapons.items():
-            weapon = wtype + "-0"
-            p_base = (1 - probabilities.edge(weapon, target))
-            p *= p_base ** quantity
 
-        total_survival_value += p * target_values[target]
+def _count_by_wtype(assignment):
+    """ counts the weapons of each type assigned to each target.
+    :param assignment: graph
+    :return: dict with d[target][weapon type] = quantity
+    """
+    counts = defaultdict(Counter)
+    for weapon, target, damage in assignment.edges():
+        counts[target][_weapon_type(weapon)] += 1
+    return counts
 
-    for target in target_values:
-        if target not in survival_value:
-            total_survival_value += target_values[target]
 
-    return total_survival_value
+@lru_cache(maxsize=None)
+def _weapon_type(weapon):
+    """ the weapon type of a weapon id, such as "tank" for "tank-3".
+    Cached, as the same weapons are assessed over and over again.
+    """
+    return weapon.split("-", 1)[0]
 
 
-def wikipedia_wtap_pretty_printer(assignment):
+def wikipedia_wtap_pretty_printer(assignment, counts=None):
     """ Produces a human readable print out of the assignment
     :param assignment: graph
+    :param counts: (optional) _count_by_wtype(assignment), if already known.
     :return: str
     """
     assert isinstance(assignment, Graph)
-    result = assignment.edges()
-    survival_value = {}
-    for item in result:
-        weapon, target, damage = item
-        if target not in survival_value:
-            survival_value[target] = {}
-        wtype = weapon.split("-")[0]
-        if wtype not in survival_value[target]:
-            survival_value[target][wtype] = 0
-        survival_value[target][wtype] += 1
-
-    lines = []
-    for target, wtypes in sorted(survival_value.items()):
-        lines.append("T-{}: ".format(target))
-        _and = " + "
-        for wtype, qty in sorted(wtypes.items()):
-            if qty > 1:
-                _wtype = wtype + "s"
-            else:
-                _wtype = wtype
-            lines.append("{} {}".format(qty, _wtype))
-            lines.append(_and)
-        lines.pop(-1)
-        lines.append(", ")
-    s = "".join(lines)
-    return s
-
-
+    if counts is None:
+        counts = _count_by_wtype(assignment)
+
+    parts = []
+    for target, wtypes in sorted(counts.items()):
+        segment = " + ".join("{} {}".format(qty, wtype + "s" if qty > 1 else wtype)
+                             for wtype, qty in sorted(wtypes.items()))
+        parts.append("T-{}: {}".format(target, segment))
+    return ", ".join(parts) + ", "